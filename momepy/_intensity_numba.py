@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# _intensity_numba.py
+# numeric kernels used by intensity characters
+#
+# Neighbourhoods are passed as CSR-like arrays: neighbours of the i-th row are
+# stored in ``indices[indptr[i]:indptr[i + 1]]`` as integer positions. If numba is
+# installed, loops are compiled and run in parallel. Otherwise equivalent NumPy
+# implementations are used.
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _segment_sum_numpy(indptr, indices, values):
+    """Sum ``values`` within each neighbourhood, accumulated in order."""
+    out = np.zeros(indptr.shape[0] - 1, dtype=values.dtype)
+    sizes = np.diff(indptr)
+    rows = np.arange(out.shape[0])
+    # add j-th neighbour of all rows at once, keeping sequential summation
+    for j in range(sizes.max() if sizes.shape[0] else 0):
+        rows = rows[sizes[rows] > j]
+        out[rows] += values[indices[indptr[rows] + j]]
+    return out
+
+
+def _segment_nunique_numpy(indptr, indices, codes):
+    """Count unique ``codes`` within each neighbourhood."""
+    rows = np.repeat(np.arange(indptr.shape[0] - 1), np.diff(indptr))
+    values = codes[indices]
+    order = np.lexsort((values, rows))
+    rows = rows[order]
+    values = values[order]
+    first = np.ones(rows.shape[0], dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (values[1:] != values[:-1])
+    return np.bincount(rows[first], minlength=indptr.shape[0] - 1)
+
+
+def _edges_length_numpy(indptr, indices, edge_ptr, edge_idx, ends, lengths):
+    """Sum ``lengths`` of edges with both nodes within each neighbourhood."""
+    n = indptr.shape[0] - 1
+    n_nodes = edge_ptr.shape[0] - 1
+    # unique (row, node) pairs encoded as single integers
+    pairs = np.unique(np.repeat(np.arange(n), np.diff(indptr)) * n_nodes + indices)
+    rows = pairs // n_nodes
+    nodes = pairs % n_nodes
+    # all edges starting at any node of each neighbourhood
+    counts = edge_ptr[nodes + 1] - edge_ptr[nodes]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    candidates = edge_idx[np.repeat(edge_ptr[nodes], counts) + offsets]
+    candidate_rows = np.repeat(rows, counts)
+    # keep those ending within the same neighbourhood
+    candidate_ends = ends[candidates]
+    within = (candidate_ends >= 0) & np.isin(
+        candidate_rows * n_nodes + candidate_ends, pairs
+    )
+    candidates = candidates[within]
+    candidate_rows = candidate_rows[within]
+    order = np.lexsort((candidates, candidate_rows))
+
+    candidate_ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(candidate_rows, minlength=n), out=candidate_ptr[1:])
+    return _segment_sum_numpy(candidate_ptr, candidates[order], lengths)
+
+
+if HAS_NUMBA:
+
+    @njit(parallel=True, cache=True)
+    def _segment_sum_numba(indptr, indices, values):
+        n = indptr.shape[0] - 1
+        out = np.zeros(n, dtype=values.dtype)
+        for i in prange(n):
+            for j in range(indptr[i], indptr[i + 1]):
+                out[i] += values[indices[j]]
+        return out
+
+    @njit(parallel=True, cache=True)
+    def _segment_nunique_numba(indptr, indices, codes):
+        n = indptr.shape[0] - 1
+        out = np.zeros(n, dtype=np.int64)
+        for i in prange(n):
+            values = np.sort(codes[indices[indptr[i] : indptr[i + 1]]])
+            for j in range(values.shape[0]):
+                if j == 0 or values[j] != values[j - 1]:
+                    out[i] += 1
+        return out
+
+    @njit(parallel=True, cache=True)
+    def _edges_length_numba(indptr, indices, edge_ptr, edge_idx, ends, lengths):
+        n = indptr.shape[0] - 1
+        out = np.zeros(n)
+        for i in prange(n):
+            nodes = np.unique(indices[indptr[i] : indptr[i + 1]])
+            size = 0
+            for node in nodes:
+                size += edge_ptr[node + 1] - edge_ptr[node]
+            candidates = np.empty(size, dtype=np.int64)
+            k = 0
+            for node in nodes:
+                for e in range(edge_ptr[node], edge_ptr[node + 1]):
+                    end = ends[edge_idx[e]]
+                    pos = np.searchsorted(nodes, end)
+                    if pos < nodes.shape[0] and nodes[pos] == end:
+                        candidates[k] = edge_idx[e]
+                        k += 1
+            for e in np.sort(candidates[:k]):
+                out[i] += lengths[e]
+        return out
+
+    _segment_sum = _segment_sum_numba
+    segment_nunique = _segment_nunique_numba
+    edges_length = _edges_length_numba
+
+else:
+    _segment_sum = _segment_sum_numpy
+    segment_nunique = _segment_nunique_numpy
+    edges_length = _edges_length_numpy
+
+
+def segment_sum(indptr, indices, values):
+    """
+    Sum ``values`` within each neighbourhood.
+
+    Values are cast to a numeric array and summed as int64 (booleans and integers)
+    or float64 (other values) to avoid overflow.
+    """
+    values = np.asarray(values)
+    dtype = np.int64 if values.dtype.kind in "biu" else np.float64
+    return _segment_sum(indptr, indices, values.astype(dtype, copy=False))
@@ -4,12 +4,15 @@
 # intensity.py
 # definitions of intensity characters
 
-import collections
-
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from shapely.ops import unary_union
 from tqdm import tqdm  # progress bar
 
+from ._intensity_numba import edges_length, segment_nunique, segment_sum
+
 __all__ = [
     "AreaRatio",
     "Count",
@@ -21,6 +24,85 @@ __all__ = [
 ]
 
 
+def _neighbours_csr(spatial_weights, keys, positional=False):
+    """
+    Pack neighbours of each row followed by the row itself into CSR-like arrays.
+
+    Parameters
+    ----------
+    spatial_weights : libpysal.weights
+        spatial weights matrix
+    keys : iterable
+        keys of ``spatial_weights.neighbors`` in the order of rows
+    positional : bool (default False)
+        if True, neighbours are integer positions of rows. Otherwise they are keys
+        and are mapped to their positions.
+
+    Raises
+    ------
+    ValueError
+        if ``positional`` and neighbours are not positions of ``keys``
+
+    Returns
+    -------
+    indptr, indices : np.array
+        rows missing in ``spatial_weights`` have an empty neighbourhood
+    """
+    keys = np.asarray(keys)
+    if not positional:
+        position = {key: i for i, key in enumerate(keys)}
+    indptr = np.zeros(keys.shape[0] + 1, dtype=np.int64)
+    indices = []
+    for i, key in enumerate(keys):
+        if key in spatial_weights.neighbors.keys():
+            neighbours = spatial_weights.neighbors[key]
+            if not positional:
+                neighbours = [position[n] for n in neighbours]
+            indices.extend(neighbours)
+            indices.append(i)
+        indptr[i + 1] = len(indices)
+    indices = np.asarray(indices, dtype=np.int64)
+    # numba kernels do not check bounds, positions have to point to existing rows
+    if positional and indices.shape[0] and (
+        indices.min() < 0 or indices.max() >= keys.shape[0]
+    ):
+        raise ValueError("Spatial weights do not match the rows of gdf.")
+    return indptr, indices
+
+
+def _fill_missing(values, indptr):
+    """
+    Set ``values`` of rows missing in spatial weights to NaN.
+
+    Such rows have an empty neighbourhood. ``values`` are returned unchanged if
+    every row has a neighbourhood, otherwise as a float copy.
+    """
+    missing = indptr[:-1] == indptr[1:]
+    if missing.any():
+        values = values.astype(np.float64)
+        values[missing] = np.nan
+    return values
+
+
+def _edges_csr(starts, ends, n):
+    """
+    Group edges by their starting node.
+
+    Nodes are expected as integer positions lower than ``n``, other ends are
+    set to ``-1``. Edge positions are kept in ascending order within each group.
+
+    Returns
+    -------
+    edge_ptr, edge_idx, ends : np.array
+    """
+    valid = (starts >= 0) & (starts < n)
+    edge_ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(starts[valid], minlength=n), out=edge_ptr[1:])
+    edge_idx = np.flatnonzero(valid)[np.argsort(starts[valid], kind="stable")]
+    ends = np.where((ends >= 0) & (ends < n), ends, -1)
+    return edge_ptr, edge_idx, ends
+
+
 class AreaRatio:
     """
     Calculate covered area ratio or floor area ratio of objects.
@@ -110,17 +192,22 @@ class AreaRatio:
             right_areas = "mm_a"
         self.right_areas = right[right_areas]
 
-        look_for = right[
-            [right_unique_id, right_areas]
-        ].copy()  # keeping only necessary columns
-        look_for.rename(index=str, columns={right_areas: "lf_area"}, inplace=True)
+        # keeping only necessary columns
+        look_for = right[[right_unique_id, right_areas]].rename(
+            columns={right_areas: "lf_area"}
+        )
         look_for = look_for.groupby(right_unique_id).sum().reset_index()
         objects_merged = left[[left_unique_id, left_areas]].merge(
             look_for, left_on=left_unique_id, right_on=right_unique_id, how="left"
         )
-        objects_merged.index = left.index
 
-        self.series = objects_merged["lf_area"] / objects_merged[left_areas]
+        # zero areas give inf or NaN without warnings, as pandas division does
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = (
+                objects_merged["lf_area"].to_numpy()
+                / objects_merged[left_areas].to_numpy()
+            )
+        self.series = pd.Series(ratio, index=left.index)
 
 
 class Count:
@@ -178,22 +265,59 @@ class Count:
         self.right_id = right[right_id]
         self.weighted = weighted
 
-        count = collections.Counter(right[right_id])
-        df = pd.DataFrame.from_dict(count, orient="index", columns=["mm_count"])
-        joined = left[[left_id, "geometry"]].join(df["mm_count"], on=left_id)
-        joined.loc[joined["mm_count"].isna(), "mm_count"] = 0
+        codes, uniques = pd.factorize(right[right_id])
+        count = pd.Series(
+            np.bincount(codes[codes >= 0], minlength=len(uniques)).astype(np.int32),
+            index=uniques,
+            name="mm_count",
+        )
+        joined = left[[left_id, "geometry"]].join(count, on=left_id)
+        joined["mm_count"] = joined["mm_count"].fillna(0).astype(np.int32)
 
         if weighted:
-            if left.geometry[0].type in ["Polygon", "MultiPolygon"]:
-                joined["mm_count"] = joined["mm_count"] / left.geometry.area
-            elif left.geometry[0].type in ["LineString", "MultiLineString"]:
-                joined["mm_count"] = joined["mm_count"] / left.geometry.length
+            # missing geometries have no type and get NaN below
+            geom_types = left.geom_type.to_numpy()[left.geometry.notna().to_numpy()]
+            if np.isin(geom_types, ["Polygon", "MultiPolygon"]).all():
+                sizes = left.geometry.area.to_numpy()
+            elif np.isin(geom_types, ["LineString", "MultiLineString"]).all():
+                sizes = left.geometry.length.to_numpy()
             else:
                 raise TypeError("Geometry type does not support weighting.")
+            # zero sizes give inf or NaN without warnings, as pandas division does
+            with np.errstate(divide="ignore", invalid="ignore"):
+                joined["mm_count"] = joined["mm_count"].to_numpy() / sizes
 
         self.series = joined["mm_count"]
 
 
+def _cascaded_union(geoms, chunk=500):
+    """
+    Union geometries in chunks and then union the partial results.
+
+    Large arrays are dissolved faster in smaller batches. Arrays shorter than
+    ``chunk`` are dissolved at once.
+    """
+    if len(geoms) <= chunk:
+        return unary_union(geoms)
+    return unary_union(
+        [unary_union(geoms[i : i + chunk]) for i in range(0, len(geoms), chunk)]
+    )
+
+
+def _count_interiors(geoms):
+    """
+    Count interior rings of dissolved geometries.
+    """
+    return len(list(_cascaded_union(geoms).interiors))
+
+
+def _count_interiors_batch(batch):
+    """
+    Count interior rings of each of dissolved groups of geometries.
+    """
+    return [_count_interiors(geoms) for geoms in batch]
+
+
 class Courtyards:
     """
     Calculate the number of courtyards within the joined structure.
@@ -209,7 +333,14 @@ class Courtyards:
         the name of the dataframe column, ``np.array``, or ``pd.Series`` where is stored block ID
     spatial_weights : libpysal.weights, optional
         spatial weights matrix - If None, Queen contiguity matrix will be calculated
-        based on objects. It is to denote adjacent buildings (note: based on integer index).
+        based on objects. It is to denote adjacent buildings (note: rows are matched
+        to ``id_order`` of weights).
+    n_jobs : int (default 1)
+        number of processes used to dissolve components in parallel using ``joblib``.
+        If -1, all CPUs are used.
+    verbose : bool (default True)
+        if True, shows progress bars in loops and indication of steps. Progress bar
+        is not shown if ``n_jobs`` is other than 1.
 
     Attributes
     ----------
@@ -228,10 +359,9 @@ class Courtyards:
     Calculating spatial weights...
     """
 
-    def __init__(self, gdf, block_id, spatial_weights=None):
+    def __init__(self, gdf, block_id, spatial_weights=None, n_jobs=1, verbose=True):
         self.gdf = gdf
 
-        results_list = []
         gdf = gdf.copy()
 
         if not isinstance(block_id, str):
@@ -241,37 +371,67 @@ class Courtyards:
         self.block_id = gdf[block_id]
         # if weights matrix is not passed, generate it from objects
         if spatial_weights is None:
-            print("Calculating spatial weights...")
+            if verbose:
+                print("Calculating spatial weights...")
             from libpysal.weights import Queen
 
             spatial_weights = Queen.from_dataframe(gdf, silence_warnings=True)
 
         self.sw = spatial_weights
-        # dict to store nr of courtyards for each uID
-        courtyards = {}
-        components = pd.Series(spatial_weights.component_labels, index=gdf.index)
-        for index in tqdm(gdf.index, total=gdf.shape[0]):
-            # if the id is already present in courtyards, continue (avoid repetition)
-            if index in courtyards:
-                continue
-            else:
-                comp = spatial_weights.component_labels[index]
-                to_join = components[components == comp].index
-                joined = gdf.loc[to_join]
-                dissolved = joined.geometry.buffer(
-                    0.01
-                ).unary_union  # buffer to avoid multipolygons where buildings touch by corners only
-                try:
-                    interiors = len(list(dissolved.interiors))
-                except (ValueError):
-                    print("Something unexpected happened.")
-                for b in to_join:
-                    courtyards[b] = interiors  # fill dict with values
-        # copy values from dict to gdf
-        for index, row in tqdm(gdf.iterrows(), total=gdf.shape[0]):
-            results_list.append(courtyards[index])
-
-        self.series = pd.Series(results_list, index=gdf.index)
+        # label connected components of adjacent buildings, rows follow id_order of
+        # weights
+        if len(spatial_weights.id_order) != gdf.shape[0]:
+            raise ValueError("Spatial weights do not match the rows of gdf.")
+        indptr, indices = _neighbours_csr(spatial_weights, spatial_weights.id_order)
+        if (indptr[:-1] == indptr[1:]).any():
+            raise ValueError("Spatial weights do not match the rows of gdf.")
+        adjacency = sparse.csr_matrix(
+            (np.ones(indices.shape[0]), indices, indptr),
+            shape=(gdf.shape[0], gdf.shape[0]),
+        )
+        n_components, labels = csgraph.connected_components(adjacency, directed=False)
+        # positions of members of each component
+        components = np.split(
+            np.argsort(labels, kind="stable"),
+            np.cumsum(np.bincount(labels, minlength=n_components))[:-1],
+        )
+
+        # buffer to avoid multipolygons where buildings touch by corners only
+        buffered = gdf.geometry.buffer(0.01).values
+        if n_jobs == 1:
+            counts = [
+                _count_interiors(buffered[positions])
+                for positions in tqdm(
+                    components,
+                    total=n_components,
+                    miniters=max(1, n_components // 200),
+                    disable=not verbose,
+                )
+            ]
+        else:
+            try:
+                from joblib import Parallel, delayed, effective_n_jobs
+            except ImportError:
+                raise ImportError("The 'joblib' package is required.")
+
+            # one batch of components per process
+            batches = np.array_split(
+                np.arange(n_components),
+                max(1, min(effective_n_jobs(n_jobs), n_components)),
+            )
+            counts = Parallel(n_jobs=n_jobs)(
+                delayed(_count_interiors_batch)(
+                    [buffered[components[c]] for c in batch]
+                )
+                for batch in batches
+            )
+            counts = [count for batch in counts for count in batch]
+
+        results = np.empty(gdf.shape[0], dtype=np.int32)
+        for positions, count in zip(components, counts):
+            results[positions] = count
+
+        self.series = pd.Series(results, index=gdf.index)
 
 
 class BlocksCount:
@@ -325,38 +485,35 @@ class BlocksCount:
         self.id = gdf[unique_id]
         self.weighted = weighted
 
-        # define empty list for results
-        results_list = []
-        data = gdf.copy()
-        if not isinstance(block_id, str):
-            data["mm_bid"] = block_id
-            block_id = "mm_bid"
-        self.block_id = data[block_id]
-        data = data.set_index(unique_id)
-
-        if weighted is True:
-            areas = data.geometry.area
-
-        for index in tqdm(data.index, total=data.shape[0]):
-            if index in spatial_weights.neighbors.keys():
-                neighbours = spatial_weights.neighbors[index].copy()
-                neighbours.append(index)
-
-                vicinity = data.loc[neighbours]
-
-                if weighted is True:
-                    results_list.append(
-                        vicinity[block_id].unique().shape[0]
-                        / sum(areas.loc[neighbours])
-                    )
-                elif weighted is False:
-                    results_list.append(vicinity[block_id].unique().shape[0])
-                else:
-                    raise ValueError("Attribute 'weighted' needs to be True or False.")
-            else:
-                results_list.append(np.nan)
+        if weighted not in [True, False]:
+            raise ValueError("Attribute 'weighted' needs to be True or False.")
+
+        if isinstance(block_id, str):
+            self.block_id = gdf[block_id]
+        else:
+            self.block_id = pd.Series(block_id, index=gdf.index)
 
-        self.series = pd.Series(results_list, index=gdf.index)
+        ids = gdf[unique_id].to_numpy()
+        indptr, indices = _neighbours_csr(spatial_weights, ids)
+        results = segment_nunique(indptr, indices, pd.factorize(self.block_id)[0])
+        if weighted:
+            areas = segment_sum(indptr, indices, gdf.geometry.area.to_numpy())
+            # rows missing in spatial_weights give 0 / 0, set to NaN below
+            with np.errstate(divide="ignore", invalid="ignore"):
+                results = results / areas
+
+        self.series = pd.Series(_fill_missing(results, indptr), index=gdf.index)
+
+
+def _ordered_sum(values):
+    """
+    Sum ``values`` one by one in order, as builtin ``sum`` does, without boxing them.
+    """
+    return np.cumsum(values)[-1] if values.shape[0] else 0
+
+
+# reductions of reached values available in Reached
+_REDUCERS = {"sum": _ordered_sum, "mean": np.nanmean, "std": np.nanstd}
 
 
 class Reached:
@@ -393,6 +550,8 @@ class Reached:
         of reached elements.
     values : str (default None)
         the name of the objects dataframe column with values used for calculations
+    verbose : bool (default True)
+        if True, shows progress bars in loops
 
     Attributes
     ----------
@@ -428,15 +587,13 @@ class Reached:
         spatial_weights=None,
         mode="count",
         values=None,
+        verbose=True,
     ):
         self.left = left
         self.right = right
         self.sw = spatial_weights
         self.mode = mode
 
-        # define empty list for results
-        results_list = []
-
         if not isinstance(right_id, str):
             right = right.copy()
             right["mm_id"] = right_id
@@ -447,51 +604,63 @@ class Reached:
             left["mm_lid"] = left_id
             left_id = "mm_lid"
         self.left_id = left[left_id]
-        if mode == "count":
-            count = collections.Counter(right[right_id])
 
-        # iterating over rows one by one
-        for index, lid in tqdm(left[left_id].iteritems(), total=left.shape[0]):
-            if spatial_weights is None:
-                ids = [lid]
+        if spatial_weights is None:
+            # every street reaches only itself
+            indptr = np.arange(left.shape[0] + 1, dtype=np.int64)
+            indices = np.arange(left.shape[0], dtype=np.int64)
+        else:
+            indptr, indices = _neighbours_csr(
+                spatial_weights, left.index, positional=True
+            )
+
+        # ids of right elements as integer codes, streets point to their code
+        # (-1 if there is no element on a street)
+        codes, uniques = pd.factorize(right[right_id])
+        street = pd.Index(uniques).get_indexer(left[left_id])
+
+        if mode == "count":
+            # streets without any element (-1) point to the trailing zero
+            count = np.bincount(codes[codes >= 0], minlength=len(uniques) + 1)
+            results = segment_sum(indptr, indices, count[street])
+        elif mode in _REDUCERS:
+            reducer = _REDUCERS[mode]
+            if values:
+                data = right[values].to_numpy()
             else:
-                neighbours = list(spatial_weights.neighbors[index])
-                neighbours.append(index)
-                ids = left.iloc[neighbours][left_id]
-            if mode == "count":
-                counts = []
-                for nid in ids:
-                    counts.append(count[nid])
-                results_list.append(sum(counts))
-            elif mode == "sum":
-                if values:
-                    results_list.append(
-                        sum(right.loc[right[right_id].isin(ids)][values])
-                    )
-                else:
-                    results_list.append(
-                        sum(right.loc[right[right_id].isin(ids)].geometry.area)
-                    )
-            elif mode == "mean":
-                if values:
-                    results_list.append(
-                        np.nanmean(right.loc[right[right_id].isin(ids)][values])
-                    )
-                else:
-                    results_list.append(
-                        np.nanmean(right.loc[right[right_id].isin(ids)].geometry.area)
-                    )
-            elif mode == "std":
-                if values:
-                    results_list.append(
-                        np.nanstd(right.loc[right[right_id].isin(ids)][values])
-                    )
+                data = right.geometry.area.to_numpy()
+            # positions of right elements grouped by their code
+            coded = codes >= 0
+            members = np.flatnonzero(coded)[np.argsort(codes[coded], kind="stable")]
+            members_ptr = np.zeros(len(uniques) + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(codes[coded], minlength=len(uniques)), out=members_ptr[1:]
+            )
+
+            results = np.full(left.shape[0], np.nan)
+            # rows with a neighbourhood, others are set to NaN below
+            rows = np.flatnonzero(np.diff(indptr))
+            # iterating over rows one by one
+            for i in tqdm(
+                rows,
+                total=rows.shape[0],
+                miniters=max(1, rows.shape[0] // 200),
+                disable=not verbose,
+            ):
+                reached = street[indices[indptr[i] : indptr[i + 1]]]
+                reached = np.unique(reached[reached >= 0])
+                if reached.shape[0]:
+                    positions = [
+                        members[members_ptr[c] : members_ptr[c + 1]] for c in reached
+                    ]
+                    positions = np.sort(np.concatenate(positions))
                 else:
-                    results_list.append(
-                        np.nanstd(right.loc[right[right_id].isin(ids)].geometry.area)
-                    )
+                    positions = np.empty(0, dtype=np.int64)
+                results[i] = reducer(data[positions])
+        else:
+            raise ValueError("Mode {} is not supported.".format(mode))
 
-        self.series = pd.Series(results_list, index=left.index)
+        self.series = pd.Series(_fill_missing(results, indptr), index=left.index)
 
 
 class NodeDensity:
@@ -516,9 +685,11 @@ class NodeDensity:
     node_degree : str (optional)
         name of the column of left gdf containing node degree. Used if ``weighted=True``
     node_start : str (default 'node_start')
-        name of the column of right gdf containing id of starting node
+        name of the column of right gdf containing id (index of left gdf) of
+        starting node
     node_end : str (default 'node_end')
-        name of the column of right gdf containing id of ending node
+        name of the column of right gdf containing id (index of left gdf) of
+        ending node
 
     Attributes
     ----------
@@ -563,33 +734,29 @@ class NodeDensity:
             self.node_degree = left[node_degree]
         self.node_start = right[node_start]
         self.node_end = right[node_end]
-        # define empty list for results
-        results_list = []
-
-        lengths = right.geometry.length
-
-        # iterating over rows one by one
-        for index in tqdm(left.index, total=left.shape[0]):
-
-            neighbours = list(spatial_weights.neighbors[index])
-            neighbours.append(index)
-            if weighted:
-                neighbour_nodes = left.iloc[neighbours]
-                number_nodes = sum(neighbour_nodes[node_degree] - 1)
-            else:
-                number_nodes = len(neighbours)
-
-            length = lengths.loc[
-                right["node_start"].isin(neighbours)
-                & right["node_end"].isin(neighbours)
-            ].sum()
+        indptr, indices = _neighbours_csr(spatial_weights, left.index)
+        if weighted:
+            degrees = left[node_degree].to_numpy(dtype=np.float64) - 1
+            number_nodes = segment_sum(indptr, indices, degrees)
+        else:
+            number_nodes = np.diff(indptr)
+
+        # length of edges with both nodes within neighbours, ids of nodes are
+        # matched to positions of rows in left (-1 if there is no such node)
+        edge_ptr, edge_idx, ends = _edges_csr(
+            left.index.get_indexer(right[node_start]),
+            left.index.get_indexer(right[node_end]),
+            left.shape[0],
+        )
+        lengths = edges_length(
+            indptr, indices, edge_ptr, edge_idx, ends, right.geometry.length.to_numpy(),
+        )
 
-            if length > 0:
-                results_list.append(number_nodes / length)
-            else:
-                results_list.append(0)
+        results = np.zeros(left.shape[0])
+        positive = lengths > 0
+        results[positive] = number_nodes[positive] / lengths[positive]
 
-        self.series = pd.Series(results_list, index=left.index)
+        self.series = pd.Series(_fill_missing(results, indptr), index=left.index)
 
 
 class Density:
@@ -640,8 +807,6 @@ class Density:
         self.sw = spatial_weights
         self.id = gdf[unique_id]
 
-        # define empty list for results
-        results_list = []
         data = gdf.copy()
 
         if values is not None:
@@ -658,21 +823,17 @@ class Density:
             areas = "mm_a"
         self.areas = data[areas]
 
-        data = data.set_index(unique_id)
-        # iterating over rows one by one
-        for index in tqdm(data.index, total=data.shape[0]):
-            if index in spatial_weights.neighbors.keys():
-                neighbours = spatial_weights.neighbors[index].copy()
-                if neighbours:
-                    neighbours.append(index)
-                else:
-                    neighbours = index
-                subset = data.loc[neighbours]
-                values_list = subset[values]
-                areas_list = subset[areas]
+        ids = data[unique_id].to_numpy()
+        indptr, indices = _neighbours_csr(spatial_weights, ids)
+        values_sum = segment_sum(
+            indptr, indices, data[values].fillna(0).to_numpy(dtype=np.float64)
+        )
+        areas_sum = segment_sum(
+            indptr, indices, data[areas].fillna(0).to_numpy(dtype=np.float64)
+        )
 
-                results_list.append(np.sum(values_list) / np.sum(areas_list))
-            else:
-                results_list.append(np.nan)
+        # rows missing in spatial_weights give 0 / 0, set to NaN below
+        with np.errstate(divide="ignore", invalid="ignore"):
+            results = values_sum / areas_sum
 
-        self.series = pd.Series(results_list, index=gdf.index)
+        self.series = pd.Series(_fill_missing(results, indptr), index=gdf.index)
@@ -1,9 +1,19 @@
 import geopandas as gpd
+import libpysal
 import momepy as mm
 import numpy as np
 import pytest
-from libpysal.weights import Queen
+from libpysal.weights import W, Queen, w_subset
+from momepy import _intensity_numba
+from momepy._intensity_numba import (
+    _edges_length_numpy,
+    _segment_nunique_numpy,
+    _segment_sum_numpy,
+    segment_sum,
+)
+from momepy.intensity import _edges_csr, _neighbours_csr, _ordered_sum
 from pytest import approx
+from shapely.geometry import Polygon
 
 
 class TestIntensity:
@@ -91,6 +101,21 @@ class TestIntensity:
         assert eib.tolist() == check_eib
         assert weib.mean() == check_weib
         assert weis.mean() == 0.020524232642849215
+        mixed = self.blocks.copy()
+        mixed.loc[3, "geometry"] = mixed.loc[3, "geometry"].exterior
+        with pytest.raises(TypeError):
+            mm.Count(mixed, self.df_buildings, "bID", "bID", weighted=True)
+        missing = self.blocks.copy()
+        missing.loc[3, "geometry"] = None
+        weib_missing = mm.Count(
+            missing, self.df_buildings, "bID", "bID", weighted=True
+        ).series
+        assert np.isnan(weib_missing[3])
+        assert weib_missing.drop(3).equals(weib.drop(3))
+        empty = self.blocks.copy()
+        empty.loc[3, "geometry"] = Polygon()
+        weib_empty = mm.Count(empty, self.df_buildings, "bID", "bID", weighted=True)
+        assert np.isinf(weib_empty.series[3])
 
     def test_Courtyards(self):
         courtyards = mm.Courtyards(self.df_buildings, "bID").series
@@ -98,9 +123,24 @@ class TestIntensity:
         courtyards_wm = mm.Courtyards(
             self.df_buildings, self.df_buildings.bID, sw
         ).series
+        courtyards_quiet = mm.Courtyards(self.df_buildings, "bID", verbose=False).series
         check = 0.6805555555555556
         assert courtyards.mean() == check
         assert courtyards_wm.mean() == check
+        assert courtyards_quiet.mean() == check
+        sw_ids = Queen.from_dataframe(self.df_buildings, ids="uID")
+        courtyards_ids = mm.Courtyards(self.df_buildings, "bID", sw_ids).series
+        assert courtyards_ids.mean() == check
+        offset = self.df_buildings.assign(uID=self.df_buildings.uID + 100)
+        sw_offset = Queen.from_dataframe(offset, ids="uID")
+        courtyards_offset = mm.Courtyards(offset, "bID", sw_offset).series
+        assert courtyards_offset.mean() == check
+        sw_drop = Queen.from_dataframe(self.df_buildings[2:], ids="uID")
+        with pytest.raises(ValueError):
+            mm.Courtyards(self.df_buildings, "bID", sw_drop)
+        pytest.importorskip("joblib")
+        courtyards_parallel = mm.Courtyards(self.df_buildings, "bID", n_jobs=2).series
+        assert courtyards_parallel.mean() == check
 
     def test_BlocksCount(self):
         sw = mm.sw_high(k=5, gdf=self.df_tessellation, ids="uID")
@@ -116,6 +156,7 @@ class TestIntensity:
         assert count.mean() == check
         assert count2.mean() == check
         assert unweigthed.mean() == check2
+        assert unweigthed.dtype == np.int64
         with pytest.raises(ValueError):
             count = mm.BlocksCount(
                 self.df_tessellation, "bID", sw, "uID", weighted="yes"
@@ -171,13 +212,34 @@ class TestIntensity:
             self.df_streets, self.df_buildings, "nID", "nID", sw
         ).series
         assert max(count) == 18
+        assert count.dtype == np.int64
         assert max(area) == 18085.45897711331
         assert max(count_sw) == 138
+        assert count_sw.dtype == np.int64
         assert max(mean) == 1808.5458977113315
         assert max(std) == 3153.7019229524785
         assert max(area_v) == 79169.31385861784
         assert max(mean_v) == 7916.931385861784
         assert max(std_v) == 8995.18003493457
+        mean_quiet = mm.Reached(
+            self.df_streets,
+            self.df_buildings,
+            "nID",
+            "nID",
+            mode="mean",
+            verbose=False,
+        ).series
+        assert max(mean_quiet) == 1808.5458977113315
+        sw_drop = mm.sw_high(k=2, gdf=self.df_streets[2:], ids="nID")
+        count_drop = mm.Reached(
+            self.df_streets, self.df_buildings, "nID", "nID", sw_drop
+        ).series
+        mean_drop = mm.Reached(
+            self.df_streets, self.df_buildings, "nID", "nID", sw_drop, mode="mean"
+        ).series
+        assert count_drop[:2].isna().all()
+        assert count_drop[2:].notna().all()
+        assert mean_drop[:2].isna().all()
 
     def test_NodeDensity(self):
         nx = mm.gdf_to_nx(self.df_streets)
@@ -192,6 +254,29 @@ class TestIntensity:
         assert density.mean() == 0.012690163074599968
         assert weighted.mean() == 0.023207675994368446
         assert array.mean() == 0.008554067995928158
+        sw_drop = mm.sw_high(k=3, weights=w_subset(W, nodes.index[2:]))
+        density_drop = mm.NodeDensity(nodes, edges, sw_drop).series
+        weighted_drop = mm.NodeDensity(
+            nodes, edges, sw_drop, weighted=True, node_degree="degree"
+        ).series
+        assert density_drop[:2].isna().all()
+        assert density_drop[2:].notna().all()
+        assert weighted_drop[:2].isna().all()
+        # ids of nodes are labels, not positions
+        nodes_offset = nodes.set_index(nodes.index + 100)
+        edges_offset = edges.copy()
+        edges_offset["node_start"] += 100
+        edges_offset["node_end"] += 100
+        sw_offset = libpysal.weights.W(
+            {k + 100: [n + 100 for n in v] for k, v in sw.neighbors.items()},
+            silence_warnings=True,
+        )
+        density_offset = mm.NodeDensity(nodes_offset, edges_offset, sw_offset).series
+        weighted_offset = mm.NodeDensity(
+            nodes_offset, edges_offset, sw_offset, weighted=True, node_degree="degree"
+        ).series
+        np.testing.assert_array_equal(density_offset.values, density.values)
+        np.testing.assert_array_equal(weighted_offset.values, weighted.values)
 
     def test_Density(self):
         sw = mm.sw_high(k=3, gdf=self.df_tessellation, ids="uID")
@@ -227,3 +312,86 @@ class TestIntensity:
             self.df_tessellation.area,
         ).series
         assert dens3.mean() == approx(1.656420)
+
+
+class TestIntensityKernels:
+    def setup_method(self):
+
+        # row 1 is missing in weights, row 2 lists node 2 twice
+        self.indptr = np.array([0, 3, 3, 6, 7])
+        self.indices = np.array([1, 2, 0, 2, 0, 2, 3])
+        self.codes = np.array([0, 1, 1, 0])
+        # edge 2 ends outside of nodes, edge 3 starts outside of nodes
+        self.edges = _edges_csr(np.array([0, 1, 2, 5, 0]), np.array([1, 2, 9, 0, 2]), 4)
+        self.lengths = np.array([1.0, 2.0, 4.0, 8.0, 16.0])
+
+    def test_neighbours_csr(self):
+        sw = W({0: [1, 2], 2: [0], 3: []}, silence_warnings=True)
+        indptr, indices = _neighbours_csr(sw, range(4), positional=True)
+        np.testing.assert_array_equal(indptr, [0, 3, 3, 5, 6])
+        np.testing.assert_array_equal(indices, [1, 2, 0, 0, 2, 3])
+        # neighbours outside of rows cannot be used as positions
+        sw_outside = W({0: [1], 1: [0, 5]}, silence_warnings=True)
+        with pytest.raises(ValueError):
+            _neighbours_csr(sw_outside, range(2), positional=True)
+
+    def test_ordered_sum(self):
+        values = np.array([0.1, 1e16, 0.2, -1e16, 0.3])
+        assert _ordered_sum(values) == sum(values)
+        assert _ordered_sum(values[:0]) == 0
+
+    def test_edges_csr(self):
+        edge_ptr, edge_idx, ends = self.edges
+        np.testing.assert_array_equal(edge_ptr, [0, 2, 3, 4, 4])
+        np.testing.assert_array_equal(edge_idx, [0, 4, 1, 2])
+        np.testing.assert_array_equal(ends, [1, 2, -1, 0, 2])
+
+    def test_segment_sum(self):
+        values = np.array([1, 10, 100, 1000])
+        expected = [111, 0, 201, 1000]
+        result = _segment_sum_numpy(self.indptr, self.indices, values)
+        np.testing.assert_array_equal(result, expected)
+        # booleans and small integers are summed without overflow
+        flags = np.ones(4, dtype=bool)
+        np.testing.assert_array_equal(
+            segment_sum(self.indptr, self.indices, flags), [3, 0, 3, 1]
+        )
+        small = np.full(4, 100, dtype=np.int8)
+        np.testing.assert_array_equal(
+            segment_sum(self.indptr, self.indices, small), [300, 0, 300, 100]
+        )
+
+        pytest.importorskip("numba")
+        for data in [values, values * 0.1]:
+            np.testing.assert_array_equal(
+                _intensity_numba._segment_sum_numba(self.indptr, self.indices, data),
+                _segment_sum_numpy(self.indptr, self.indices, data),
+            )
+
+    def test_segment_nunique(self):
+        expected = [2, 0, 2, 1]
+        result = _segment_nunique_numpy(self.indptr, self.indices, self.codes)
+        np.testing.assert_array_equal(result, expected)
+
+        pytest.importorskip("numba")
+        np.testing.assert_array_equal(
+            _intensity_numba._segment_nunique_numba(
+                self.indptr, self.indices, self.codes
+            ),
+            expected,
+        )
+
+    def test_edges_length(self):
+        expected = [19.0, 0.0, 16.0, 0.0]
+        result = _edges_length_numpy(
+            self.indptr, self.indices, *self.edges, self.lengths
+        )
+        np.testing.assert_array_equal(result, expected)
+
+        pytest.importorskip("numba")
+        np.testing.assert_array_equal(
+            _intensity_numba._edges_length_numba(
+                self.indptr, self.indices, *self.edges, self.lengths
+            ),
+            expected,
+        )